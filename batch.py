@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Batch runner for the download -> process -> stats -> AEP -> report pipeline.
+
+Usage:
+    python -m era5analysis.batch jobs.yaml [-o OUTPUT_DIR] [-w WORKERS]
+
+The job file (YAML or JSON) lists the studies to run:
+
+    output_dir: nightly
+    workers: 4
+    jobs:
+      - name: hovsore
+        analysis: time_series
+        coords: [56.44, 8.15]
+        period: ["2000-01-01", "2020-12-31"]
+        frequency: hourly
+        turbines: ["../docs/GE_WIND_ENERGY_GE_750i_750 50_WAsP.wtg"]
+      - name: north_sea
+        analysis: spatial
+        coords: [58, 2, 53, 9]
+        period: ["2010-01-01", "2020-12-31"]
+        frequency: hourly
+        site: [55.5, 7.0]
+        turbines: ["../docs/GE_WIND_ENERGY_GE_750i_750 50_WAsP.wtg"]
+        aep: {pvalues: [50, 90], n_boot: 2000}
+
+AEP needs hourly data, and spatial jobs with a report need a site [LAT, LON]
+for the time series and wind rose.
+
+Every step is a task whose result is written to a file in the output
+directory. The file name holds a hash of the task parameters and of its
+inputs, so editing a job produces new results instead of reusing old ones.
+Downloads and processed data are shared between jobs asking for the same
+area and period. A task whose output already exists is not run again, so
+an interrupted batch resumes where it stopped when restarted.
+The power curves of the turbines are parsed once and shared by all workers
+through the cache directory. Turbine files are given relative to the job file.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import matplotlib
+# the pipeline functions draw figures, which must not open windows; this has
+# to be set before they import pyplot
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+
+from era5analysis import era5_funcs, get_stats, get_AEP, get_report
+
+
+# %% Reading the job file
+def load_jobs(jobfile):
+    """Function to read the job list from a YAML or JSON file.
+
+    Args:
+        jobfile (str): Path of the .yaml/.yml or .json job file.
+
+    Returns:
+        (dict): Settings of the batch with the list of jobs under "jobs".
+    """
+    with open(jobfile) as f:
+        if jobfile.endswith((".yaml", ".yml")):
+            import yaml  # only needed for YAML job files
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+    if isinstance(config, list):
+        config = {"jobs": config}
+    names = set()
+    for i, job in enumerate(config["jobs"]):
+        job.setdefault("name", "job{}".format(i))
+        job.setdefault("frequency", "hourly")
+        job.setdefault("turbines", [])
+        job.setdefault("report", True)
+        job["period"] = [str(date) for date in job["period"]]
+        job["turbines"] = [os.path.join(os.path.dirname(os.path.abspath(jobfile)),
+                                        wtg_file) for wtg_file in job["turbines"]]
+        if job["name"] in names:
+            raise ValueError('Duplicate job name "{}"'.format(job["name"]))
+        names.add(job["name"])
+        if job["analysis"] not in ("time_series", "spatial"):
+            raise ValueError(
+                'Job "{}": analysis must be "time_series" or "spatial"'.format(
+                    job["name"])
+            )
+        stems = [os.path.splitext(os.path.basename(wtg_file))[0]
+                 for wtg_file in job["turbines"]]
+        if len(set(stems)) != len(stems):
+            raise ValueError(
+                'Job "{}": turbine files must have different names'.format(
+                    job["name"])
+            )
+        if (job["turbines"] or "aep" in job) and job["frequency"] != "hourly":
+            raise ValueError(
+                'Job "{}": the AEP can only be computed from hourly data'.format(
+                    job["name"])
+            )
+        if (job["analysis"] == "spatial" and job["report"]
+                and len(job.get("site") or []) != 2):
+            raise ValueError(
+                'Job "{}": the report of a spatial analysis needs a site: '
+                '[LAT, LON]'.format(job["name"])
+            )
+    return config
+
+
+# %% Building the task graph
+def _task(tasks, kind, directory, name, params, deps=(), exclusive=False,
+          fingerprint=None):
+    """Task whose output file name holds a hash of its parameters, of the
+    outputs of the tasks it depends on and of the optional fingerprint."""
+    key = json.dumps([kind, params, [tasks[dep]["output"] for dep in deps],
+                      fingerprint], sort_keys=True)
+    stem, ext = os.path.splitext(name)
+    output = os.path.join(directory, "{}_{}{}".format(
+        stem, hashlib.sha1(key.encode()).hexdigest()[:12], ext))
+    return {"kind": kind, "output": output, "params": params,
+            "deps": list(deps), "exclusive": exclusive}
+
+
+def build_tasks(jobs, output_dir):
+    """Function to build the task graph of a list of jobs.
+
+    Args:
+        jobs (list): List of job dictionaries (see load_jobs).
+        output_dir (str): Directory where the results are written.
+
+    Returns:
+        (dict): Tasks keyed by their id. Each task holds its kind, output
+                file, parameters and the ids of the tasks it depends on.
+    """
+    cache_dir = os.path.join(output_dir, "cache")
+    tasks = {}
+    for job in jobs:
+        job_dir = os.path.join(output_dir, job["name"])
+        # identical requests to the CDS are downloaded and processed once
+        request = [job["analysis"], job["coords"], job["period"],
+                   job["frequency"]]
+        key = hashlib.sha1(json.dumps(request).encode()).hexdigest()[:12]
+        download = "download:" + key
+        process = "process:" + key
+        tasks[download] = _task(
+            tasks, "download", cache_dir, "download.nc",
+            {"initial_date": job["period"][0], "final_date": job["period"][1],
+             "extent_coords": job["coords"], "frequency": job["frequency"],
+             "analysis": job["analysis"]})
+        tasks[process] = _task(
+            tasks, "process", cache_dir, "process.pkl",
+            {"analysis": job["analysis"]}, deps=[download])
+        tasks["stats:" + job["name"]] = _task(
+            tasks, "stats", job_dir, "stats.pkl",
+            {"analysis": job["analysis"]}, deps=[process])
+        for wtg_file in job["turbines"]:
+            turbine = os.path.splitext(os.path.basename(wtg_file))[0]
+            tasks["aep:{}:{}".format(job["name"], turbine)] = _task(
+                tasks, "aep", job_dir, "aep_{}.pkl".format(turbine),
+                {"analysis": job["analysis"],
+                 "wtg_file": wtg_file,
+                 "turbine_cache": os.path.join(cache_dir, "turbines"),
+                 "options": job.get("aep", {})}, deps=[process],
+                # a missing file makes only this task fail when it runs
+                fingerprint=(os.path.getmtime(wtg_file)
+                             if os.path.exists(wtg_file) else None))
+        if job["report"]:
+            site = job.get("site", [None, None])
+            # get_report writes its figures to fixed paths, so reports
+            # are never run at the same time
+            tasks["report:" + job["name"]] = _task(
+                tasks, "report", job_dir, "report.pdf",
+                {"analysis": job["analysis"], "frequency": job["frequency"],
+                 "lat": site[0], "lon": site[1],
+                 "cache_dir": os.path.join(cache_dir, "maps")},
+                deps=[process], exclusive=True)
+    return tasks
+
+
+# %% Running the tasks
+_turbines = {}  # turbine registry of this process, by cache directory
+
+
+def _turbine_registry(cache_dir):
+    if cache_dir not in _turbines:
+        _turbines[cache_dir] = get_AEP.TurbineRegistry(cache_dir=cache_dir)
+    return _turbines[cache_dir]
+
+
+def _load(file):
+    with open(file, "rb") as f:
+        return pickle.load(f)
+
+
+def _dump(obj, file):
+    with open(file, "wb") as f:
+        pickle.dump(obj, f)
+
+
+def prepare_turbines(tasks):
+    """Function to parse the turbines of the pending AEP tasks once, before
+    the tasks are sent to the workers, which then load the cached tables.
+
+    Args:
+        tasks (dict): Task graph (see build_tasks).
+    """
+    for tid, task in tasks.items():
+        if task["kind"] != "aep" or os.path.exists(task["output"]):
+            continue
+        try:
+            _turbine_registry(task["params"]["turbine_cache"]).get(
+                task["params"]["wtg_file"])
+        except Exception as err:  # the AEP task reports the error
+            print("WARNING {}: {!r}".format(tid, err))
+
+
+def run_task(kind, output, inputs, params):
+    """Function to run a single task and write its result to the output file.
+
+    The result is first written to a temporary file and then renamed, so an
+    output file only exists when the task has finished. The figures drawn by
+    the task are closed afterwards, as the worker processes are reused.
+
+    Args:
+        kind (str): "download", "process", "stats", "aep" or "report".
+        output (str): Full path of the output file.
+        inputs (list): Output files of the tasks this one depends on.
+        params (dict): Parameters of the task.
+    """
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    tmp = output + ".tmp"
+    try:
+        if kind == "download":
+            shutil.move(era5_funcs.download_ERA5(**params), tmp)
+        elif kind == "process":
+            data = era5_funcs.processing_ERA5(inputs[0], params["analysis"])
+            _dump(data.load() if params["analysis"] == "spatial" else data, tmp)
+        elif kind == "stats":
+            _dump(get_stats.get_stats(_load(inputs[0]), params["analysis"]), tmp)
+        elif kind == "aep":
+            wt_wtg = _turbine_registry(params["turbine_cache"]).get(
+                params["wtg_file"])
+            aep = get_AEP.AEP_bootstrap(_load(inputs[0]), params["analysis"],
+                                        wt_wtg, **params["options"])
+            _dump(aep, tmp)
+        elif kind == "report":
+            get_report.get_report(_load(inputs[0]), **params)
+            report = os.path.join(os.path.dirname(get_report.__file__), "..",
+                                  "report_{}.pdf".format(params["analysis"]))
+            shutil.move(report, tmp)
+        os.replace(tmp, output)
+    finally:
+        plt.close("all")
+
+
+def _restart(pool, workers):
+    """Replace a pool whose worker processes died by a new one."""
+    print("Restarting the worker processes.")
+    pool.shutdown(wait=False)
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def run_tasks(tasks, workers=None):
+    """Function to run a task graph, running the independent tasks in parallel.
+
+    Tasks whose output file already exists are considered done. When a task
+    fails, the tasks depending on it are skipped and the rest continue. If a
+    worker process dies (e.g. out of memory), the tasks running at that time
+    fail and the worker processes are restarted for the remaining tasks.
+
+    Args:
+        tasks (dict): Task graph (see build_tasks).
+        workers (int, optional): Number of worker processes. Defaults to the
+                        number of CPUs.
+
+    Returns:
+        (tuple): Sets with the ids of the done, failed and skipped tasks.
+    """
+    done = {tid for tid, task in tasks.items() if os.path.exists(task["output"])}
+    failed, skipped = set(), set()
+    if done:
+        print("Resuming: {} of {} tasks already done.".format(
+            len(done), len(tasks)))
+    running = {}  # future -> task id
+    pools = {}  # future -> pool running it
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            busy = set(running.values())
+            for tid, task in tasks.items():
+                if tid in done or tid in failed or tid in skipped or tid in busy:
+                    continue
+                if any(dep in failed or dep in skipped for dep in task["deps"]):
+                    skipped.add(tid)
+                    print("SKIPPED {}".format(tid))
+                    continue
+                if not all(dep in done for dep in task["deps"]):
+                    continue
+                if task["exclusive"] and any(
+                        tasks[other]["exclusive"] for other in busy):
+                    continue
+                inputs = [tasks[dep]["output"] for dep in task["deps"]]
+                args = (run_task, task["kind"], task["output"], inputs,
+                        task["params"])
+                try:
+                    future = pool.submit(*args)
+                except BrokenProcessPool:
+                    pool = _restart(pool, workers)
+                    future = pool.submit(*args)
+                running[future] = tid
+                pools[future] = pool
+                busy.add(tid)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in finished:
+                tid = running.pop(future)
+                try:
+                    future.result()
+                except BrokenProcessPool as err:
+                    # restart the pool only once, not for each of its tasks
+                    broken = broken or pools[future] is pool
+                    failed.add(tid)
+                    print("FAILED  {}: worker process died {!r}".format(tid, err))
+                except Exception as err:
+                    failed.add(tid)
+                    print("FAILED  {}: {!r}".format(tid, err))
+                else:
+                    done.add(tid)
+                    print("DONE    {}".format(tid))
+                del pools[future]
+            if broken:
+                pool = _restart(pool, workers)
+    finally:
+        pool.shutdown()
+    return done, failed, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run batches of ERA5 wind resource and AEP studies.")
+    parser.add_argument("jobfile", help="YAML or JSON file with the jobs")
+    parser.add_argument("-o", "--output-dir",
+                        help="directory for the results and cached data")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="number of worker processes")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only list the tasks that would be run")
+    args = parser.parse_args(argv)
+
+    config = load_jobs(args.jobfile)
+    output_dir = os.path.abspath(
+        args.output_dir or config.get("output_dir", "era5analysis_batch"))
+    tasks = build_tasks(config["jobs"], output_dir)
+    if args.dry_run:
+        for tid, task in tasks.items():
+            state = "done" if os.path.exists(task["output"]) else "todo"
+            print("{:5} {} -> {}".format(state, tid, task["output"]))
+        return 0
+    prepare_turbines(tasks)
+    done, failed, skipped = run_tasks(tasks, args.workers or config.get("workers"))
+    print("{} done, {} failed, {} skipped.".format(
+        len(done), len(failed), len(skipped)))
+    return 1 if failed or skipped else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -27,6 +27,9 @@ def download_ERA5(initial_date, final_date, extent_coords, frequency, analysis):
                             options are: "hourly" and "monthly".
         analysis (str): This is the type of analysis to be performed, which can be 
                         "spatial" for maps or "time_series" for time series.
+
+    Returns:
+        (str): Full path of the downloaded netcdf file.
     """
     # This sets the api key in the home directory to be able to download the data
     file_path = os.path.realpath(__file__)  # script full name
@@ -93,6 +96,13 @@ def download_ERA5(initial_date, final_date, extent_coords, frequency, analysis):
         .replace(" ", "")
     )  # To format the outputfile
 
+    filename = "{}-{}-{}-{}.nc".format(
+        product,
+        initial_date.replace("-", ""),
+        final_date.replace("-", ""),
+        tight_coords,
+    )
+
     # Setting the request
     c = cdsapi.Client()
     c.retrieve(
@@ -109,13 +119,9 @@ def download_ERA5(initial_date, final_date, extent_coords, frequency, analysis):
             "date": "{}/{}".format(initial_date, final_date),
             "area": extent_coords,
         },
-        "{}-{}-{}-{}.nc".format(
-            product,
-            initial_date.replace("-", ""),
-            final_date.replace("-", ""),
-            tight_coords,
-        ),
+        filename,
     )
+    return os.path.join(current_dir, filename)
 
 
 # Processing ERA5 data
@@ -6,13 +6,19 @@ from era5analysis import era5_funcs, get_stats, get_report
 import numpy as np
 import matplotlib.pylab as plt
 import os
+import hashlib
 import numpy as np
+import pandas as pd
+import xarray as xr
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 # Imports Wind Turbine class from Pywake
 from py_wake.wind_turbines import WindTurbines
 
 
 # %% Generating Power and Thrust curves of a wind turbine
-def PT(path, filename):
+def PT(path, filename, plot=True):
     '''
     This function generates power and thrust co efficient curves for the user
      desired Wind turbine. The input file needs to be WaSP file(.WTG)
@@ -23,6 +29,7 @@ def PT(path, filename):
         DESCRIPTION.
     filename(str) : .WTG Filename in the specified path
         DESCRIPTION.
+    plot(bool) : Plot the power and thrust curves. Defaults to True.
 
     Returns
     -------
@@ -34,6 +41,8 @@ def PT(path, filename):
     os.chdir(current_dir)
     wtg_file = os.path.join(path, filename)  # joins the path and filename
     wt_wtg = WindTurbines.from_WAsP_wtg(wtg_file)  # reads  .wtg file
+    if not plot:
+        return wt_wtg
     ws = np.arange(4, 25)  # windspeed
     ct = wt_wtg.ct(ws)  # Thrust coefficient values taken from wtg object
     power = wt_wtg.power(ws)  # Power values
@@ -55,6 +64,125 @@ def PT(path, filename):
     return wt_wtg
 
 
+# %% Registry of tabulated wind turbines
+class TurbineTable:
+    '''
+    Power and thrust coefficient curves of a wind turbine tabulated on a
+    dense wind speed grid. It can be used in place of the wind turbine
+    generator object in the AEP functions, without PyWake's interpolation.
+
+    Parameters
+    ----------
+    ws : Wind speeds of the table [m/s], increasing.
+    power : Power [W] at each wind speed.
+    ct : Thrust coefficient [-] at each wind speed.
+
+    '''
+
+    def __init__(self, ws, power, ct):
+        self.ws = ws
+        self._power = power
+        self._ct = ct
+
+    def power(self, ws):
+        return np.interp(ws, self.ws, self._power, left=0, right=0)
+
+    def ct(self, ws):
+        return np.interp(ws, self.ws, self._ct, left=0, right=0)
+
+
+class TurbineRegistry:
+    '''
+    Registry of wind turbines read from WAsP .wtg files. Each file is parsed
+    once per modification time and its curves are kept as a TurbineTable in
+    a least recently used cache of at most maxsize turbines. The curves are
+    tabulated every ws_step, plus the wind speeds where the power steps from
+    or to zero (cut-in and cut-out), which are located within 1e-6 m/s so
+    the steps are not smeared by the interpolation.
+
+    If cache_dir is given, the tables are also saved there as .npy files.
+    Other processes using the same cache_dir load (memory-map) the tables
+    instead of parsing the .wtg files again.
+
+    Parameters
+    ----------
+    maxsize (int): Number of turbines kept in memory.
+    cache_dir (str): Directory where the tables are persisted.
+    ws_step (float): Wind speed resolution of the tables [m/s].
+    ws_max (float): Highest wind speed of the tables [m/s].
+
+    '''
+
+    def __init__(self, maxsize=128, cache_dir=None, ws_step=0.05, ws_max=40.0):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.ws_step = ws_step
+        self.ws_max = ws_max
+        self._tables = OrderedDict()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def clear(self):
+        self._tables.clear()
+
+    def get(self, wtg_file):
+        '''
+        Return the TurbineTable of a .wtg file, parsing the file only if it
+        is not cached yet or it has changed since it was cached.
+        '''
+        wtg_file = os.path.realpath(wtg_file)
+        key = (wtg_file, os.path.getmtime(wtg_file))
+        if key in self._tables:
+            self._tables.move_to_end(key)
+            return self._tables[key]
+        table = self._load(key)
+        if table is None:
+            table = self._save(key, self._parse(wtg_file))
+        self._tables[key] = table
+        if len(self._tables) > self.maxsize:
+            self._tables.popitem(last=False)
+        return table
+
+    def _parse(self, wtg_file):
+        wt_wtg = WindTurbines.from_WAsP_wtg(wtg_file)  # reads  .wtg file
+        ws = np.arange(0, self.ws_max + self.ws_step/2, self.ws_step)
+        stopped = wt_wtg.power(ws) == 0
+        # bisect the intervals where the turbine starts or stops producing
+        edges = np.flatnonzero(stopped[:-1] != stopped[1:])
+        lo, hi = ws[edges], ws[edges + 1]
+        while np.any(hi - lo > 1e-6):
+            mid = (lo + hi) / 2
+            same = (wt_wtg.power(mid) == 0) == stopped[edges]
+            lo, hi = np.where(same, mid, lo), np.where(same, hi, mid)
+        ws = np.unique(np.r_[ws, lo, hi])
+        return np.vstack([ws, wt_wtg.power(ws), wt_wtg.ct(ws)])
+
+    def _cache_file(self, key):
+        name = '{}:{}:{}:{}'.format(*key, self.ws_step, self.ws_max)
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(name.encode()).hexdigest() + '.npy')
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        cache_file = self._cache_file(key)
+        if not os.path.exists(cache_file):
+            return None
+        return TurbineTable(*np.load(cache_file, mmap_mode='r'))
+
+    def _save(self, key, table):
+        if self.cache_dir is None:
+            return TurbineTable(*table)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_file = self._cache_file(key)
+        tmp = cache_file + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, table)
+        os.replace(tmp, cache_file)  # atomic, other processes may read it
+        return TurbineTable(*table)
+
+
 # %% Calculate AEP for specified wind turbine and wind speed data
 def AEP(data, analysis, vref, PT, lat=None, lon=None):
     '''
@@ -70,7 +198,7 @@ def AEP(data, analysis, vref, PT, lat=None, lon=None):
 
     Returns
     -------
-    None.
+    aep10m, aep100m : AEP [Wh] at 10 m and 100 m height.
 
     '''
     file_path = os.path.realpath(__file__)  # script full name
@@ -140,4 +268,189 @@ def AEP(data, analysis, vref, PT, lat=None, lon=None):
         plt.title('Power and AEP generated for each wind speed', fontsize=15)
         plt.tight_layout()
         plt.show()
-    return
+    return aep10m, aep100m
+
+
+# %% Uncertainty of the AEP from the interannual variability
+def power_lookup(PT, ws_step=0.1, ws_max=40.0):
+    '''
+    This function samples the power curve of the wind turbine once on a
+    dense, evenly spaced wind speed grid, so that large wind speed arrays
+    can be converted to power with a plain index lookup.
+
+    Parameters
+    ----------
+    PT : Wind turbine generator object (see PT function).
+    ws_step (float): Width of the wind speed bins [m/s].
+    ws_max (float): Upper edge of the last wind speed bin [m/s].
+
+    Returns
+    -------
+    Power [W] at the centre of each wind speed bin.
+
+    '''
+    ws_centres = np.arange(0, ws_max, ws_step) + ws_step/2
+    return np.asarray(PT.power(ws_centres), dtype=float)
+
+
+def _block_codes(time, block, min_coverage=0.9):
+    '''
+    Split the time steps in blocks (years or fixed number of samples) and
+    return the start and stop index of each block. Blocks with less than
+    min_coverage of their expected number of samples, like an incomplete
+    first or last year, are left out with a warning. Blocks are assumed to
+    be contiguous in time, as in ERA5 files.
+    '''
+    if block == 'year':
+        time = pd.DatetimeIndex(time)
+        codes = time.year.values
+    else:
+        codes = np.arange(len(time)) // int(block)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    stops = np.r_[starts[1:], len(codes)]
+    if block == 'year':
+        step = np.median(np.diff(time.values)) / np.timedelta64(1, 's')
+        days = np.where(pd.DatetimeIndex(
+            [f'{year}-12-31' for year in codes[starts]]).is_leap_year, 366, 365)
+        expected = days * 24 * 3600 / step
+    else:
+        expected = int(block)
+    keep = stops - starts >= min_coverage * expected
+    if not keep.all():
+        print('WARNING: {} {} with less than {:.0%} of the expected samples '
+              'left out of the bootstrap.'.format(
+                  (~keep).sum(), 'years' if block == 'year' else 'blocks',
+                  min_coverage))
+    return starts[keep], stops[keep]
+
+
+def _bootstrap_chunk(ws, starts, stops, resamples, power, ws_step, pvalues):
+    '''
+    Bootstrap the AEP [Wh] of a (time, sites) array of wind speeds and
+    return the P-values with shape (len(pvalues), sites). Missing (NaN)
+    wind speeds are left out of both the energy and the number of samples.
+    The blocks are reduced one at a time to limit the temporary arrays.
+    '''
+    hrs_per_year = 365 * 24  # hours per year
+    energy = np.empty((starts.size, ws.shape[1]))  # (blocks, sites)
+    counts = np.empty((starts.size, ws.shape[1]))
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        block = ws[start:stop]
+        valid = np.isfinite(block)
+        idx = (np.where(valid, block, 0) / ws_step).astype(np.int32)
+        np.clip(idx, 0, power.size - 1, out=idx)
+        energy[i] = np.where(valid, power[idx], 0).sum(axis=0)
+        counts[i] = valid.sum(axis=0)
+    # each bootstrap sample is the mean power over the resampled blocks
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_power = (resamples @ energy) / (resamples @ counts)
+    aep = hrs_per_year * mean_power
+    # PXX is the AEP exceeded with XX % probability
+    return np.percentile(aep, [100 - p for p in pvalues], axis=0)
+
+
+def AEP_bootstrap(data, analysis, PT, pvalues=(50, 75, 90), horizon=1,
+                  n_boot=1000, block='year', ws_step=0.1, seed=None,
+                  n_workers=None, chunk_bytes=2**27, min_coverage=0.9):
+    '''
+    This function estimates the uncertainty of the Annual Energy Production
+    due to the interannual variability of the wind, by resampling whole
+    years (or blocks of samples) of the ERA5 data with replacement. The
+    power curve is sampled only once and every site of a spatial dataset
+    is resampled with the same set of years, so no figures are produced
+    and the calculation is vectorized over sites and bootstrap samples.
+
+    Each bootstrap sample is the mean AEP over `horizon` resampled years,
+    so PXX is the AEP averaged over `horizon` years that is exceeded with
+    XX % probability. With horizon=1 this is the P-value of a single year;
+    the spread narrows for longer horizons, e.g. 10 years for a
+    10-year P90. Missing (NaN) wind speeds are ignored, and years (or
+    blocks) with less than min_coverage of their expected samples, like an
+    incomplete first or last year, are left out since their seasonal bias
+    would otherwise be drawn as a full year.
+
+    Parameters
+    ----------
+    data : Wind speed data, either a dataframe (time_series) with a time
+    index or a 3d-dataset (spatial).
+    analysis (str): Type of analysis to be carried out either
+    time_series/spatial
+    PT : Wind turbine generator object (see PT function).
+    pvalues (tuple): Exceedance probabilities [%] to compute, e.g. P50/P90.
+    horizon (int): Number of years (or blocks) in each bootstrap sample.
+    n_boot (int): Number of bootstrap samples.
+    block : 'year' to resample calendar years or an int to resample blocks
+    of that many samples.
+    ws_step (float): Width of the wind speed bins of the power lookup [m/s].
+    seed (int): Seed of the random generator, for reproducible results.
+    n_workers (int): Number of processes used for spatial data. Defaults to
+    None, which runs in the current process.
+    chunk_bytes (int): Approximate size of the wind speeds of the grid
+    points handled by each task [bytes]. Defaults to 128 MB.
+    min_coverage (float): Minimum fraction of the expected samples of a
+    year (or block) to use it.
+
+    Returns
+    -------
+    AEP [MWh] for each P-value at 10 m and 100 m height. A dataframe for
+    time_series analysis, or a dataset with dimensions (pvalue, latitude,
+    longitude) for spatial analysis.
+
+    '''
+    power = power_lookup(PT, ws_step)
+    if analysis == 'time_series':
+        if isinstance(data.index, pd.DatetimeIndex) or block != 'year':
+            time = data.index
+        else:
+            time = data['time']
+    elif analysis == 'spatial':
+        time = data.time.values
+    starts, stops = _block_codes(time, block, min_coverage)
+    if starts.size < 2:
+        raise ValueError(
+            'At least two years (or blocks) of data are needed to estimate '
+            'the interannual variability of the AEP.')
+    # how many times each block is drawn in each bootstrap sample
+    rng = np.random.default_rng(seed)
+    resamples = rng.multinomial(horizon, np.full(starts.size, 1/starts.size),
+                                size=n_boot).astype(float)
+    labels = [f'P{p}' for p in pvalues]
+
+    if analysis == 'time_series':
+        ws = np.column_stack([data.WS10m, data.WS100m]).astype(float)
+        aep = _bootstrap_chunk(ws, starts, stops, resamples, power, ws_step,
+                               pvalues)
+        return pd.DataFrame(aep/1e6, index=labels,
+                            columns=['AEP10m', 'AEP100m'])
+
+    # rows of latitudes handled by each task, within the memory budget
+    n_time, n_lat, n_lon = (data.sizes[dim]
+                            for dim in ['time', 'latitude', 'longitude'])
+    rows = max(int(chunk_bytes // (8 * n_time * n_lon)), 1)
+    with (ProcessPoolExecutor(max_workers=n_workers) if n_workers
+          else nullcontext()) as pool:
+        aep_ds = xr.Dataset()
+        for height in ['10m', '100m']:
+            ws = data[f'WS{height}'].transpose('time', 'latitude', 'longitude')
+            results, pending = [], deque()
+            for i in range(0, n_lat, rows):
+                # only the wind speeds of this chunk are loaded in memory
+                chunk = ws.isel(latitude=slice(i, i + rows)).values.astype(float)
+                args = (chunk.reshape(n_time, -1), starts, stops, resamples,
+                        power, ws_step, pvalues)
+                if pool is None:
+                    results.append(_bootstrap_chunk(*args))
+                    continue
+                # keep at most two chunks per worker waiting in the queue
+                pending.append(pool.submit(_bootstrap_chunk, *args))
+                if len(pending) >= 2 * n_workers:
+                    results.append(pending.popleft().result())
+            results += [future.result() for future in pending]
+            aep = np.concatenate(results, axis=1).reshape(len(pvalues), n_lat,
+                                                           n_lon)
+            aep_ds[f'AEP{height}'] = xr.DataArray(
+                aep/1e6, dims=('pvalue', 'latitude', 'longitude'),
+                coords={'pvalue': labels, 'latitude': data.latitude,
+                        'longitude': data.longitude},
+                attrs={'units': 'MWh'})
+    return aep_ds
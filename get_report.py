@@ -4,7 +4,7 @@ from era5analysis import get_stats
 import os
 
 
-def get_report(data, analysis, frequency, lat=None, lon=None):
+def get_report(data, analysis, frequency, lat=None, lon=None, cache_dir=None):
     """This function creates a report of the performed analysis, showing
     the plots arrangd in a .pdf file.
 
@@ -18,6 +18,8 @@ def get_report(data, analysis, frequency, lat=None, lon=None):
                         in the spatial data. Defaults to None.
         lat (float, optional): This is the longitude for performing time series analysis
                         in the spatial data. Defaults to None.
+        cache_dir (str, optional): Directory where the time-mean maps of the
+                        spatial data are cached. Defaults to None.
     """
     file_path = os.path.realpath(__file__)  # script full name
     current_dir = os.path.dirname(file_path)  # script directory
@@ -88,7 +90,7 @@ def get_report(data, analysis, frequency, lat=None, lon=None):
     elif analysis == 'spatial':
         ds = data
         # Calling plotting functions
-        get_stats.plot_spatial_map(ds)
+        get_stats.plot_spatial_map(ds, cache_dir)
         get_stats.plot_spatial_timeseries(ds, lat, lon)
         get_stats.plot_windrose(ds, analysis, lat, lon)
         #
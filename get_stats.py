@@ -3,7 +3,11 @@ from windrose import WindroseAxes, WindAxes
 from matplotlib import pyplot as plt
 import matplotlib.cm as cm
 import numpy as np
+import xarray as xr
 import os, sys
+import hashlib
+import json
+from collections import OrderedDict
 
 # %% Getting the statistics of the data
 
@@ -129,14 +133,112 @@ def plot_timeseries(df):
     fig.savefig('../docs/time_series.png', dpi=300)
 
 
-def plot_spatial_map(ds):
+_time_means = OrderedDict()  # time-mean fields already computed, by key
+_MAX_TIME_MEANS = 8  # number of time-mean fields kept in memory
+
+
+def _mean_key(ds, var):
+    """Key identifying a variable of a dataset by its coordinates and either
+    its source file and modification time, or all of its values when the
+    dataset was not read from a file."""
+    digest = hashlib.sha1(var.encode())
+    for dim in ['time', 'latitude', 'longitude']:
+        digest.update(np.ascontiguousarray(ds[dim].values).tobytes())
+    source = ds.encoding.get('source')
+    if source is not None and os.path.exists(source):
+        digest.update(json.dumps([os.path.realpath(source),
+                                  os.path.getmtime(source)]).encode())
+    else:
+        digest.update(np.ascontiguousarray(ds[var].values).tobytes())
+    return digest.hexdigest()
+
+
+def time_mean(ds, var, cache_dir=None):
+    """
+    This function gives the time-mean field of a variable of the spatial
+    data. The field is computed once and kept in memory, and in cache_dir
+    as a netcdf file if given, so maps can be redrawn without reducing
+    the full dataset again. Fields are matched by the variable, the
+    coordinates and the source file and its modification time; datasets
+    not read from a file are matched by all of their values instead.
+
+    Inputs
+    ----------
+    ds (object) : Spatial dataset.
+    var (str) : Variable name, e.g. WS10m or WS100m.
+    cache_dir (str) : Directory to store the mean fields. Optional.
+
+    Returns
+    -------
+    Time-mean field (latitude, longitude) of the variable.
+    """
+    key = _mean_key(ds, var)
+    if key in _time_means:
+        _time_means.move_to_end(key)
+        return _time_means[key]
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, '{}_{}.nc'.format(var, key))
+    if cache_file is not None and os.path.exists(cache_file):
+        mean = xr.load_dataarray(cache_file)
+    else:
+        mean = ds[var].mean('time').load()
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = cache_file + '.{}.tmp'.format(os.getpid())
+            mean.to_netcdf(tmp)
+            os.replace(tmp, cache_file)
+    _time_means[key] = mean
+    if len(_time_means) > _MAX_TIME_MEANS:
+        _time_means.popitem(last=False)
+    return mean
+
+
+def downsample(da, max_size):
+    """
+    This function averages blocks of grid points of a map so that neither
+    side is larger than max_size points.
+
+    Inputs
+    ----------
+    da (object) : Field with latitude and longitude dimensions.
+    max_size (int) : Maximum number of points along each side.
+
+    Returns
+    -------
+    Downsampled field.
+    """
+    factor = int(np.ceil(max(da.sizes['latitude'], da.sizes['longitude'])
+                         / max_size))
+    if factor <= 1:
+        return da
+    return da.coarsen(latitude=factor, longitude=factor,
+                      boundary='pad').mean()
+
+
+def _block_mean(values, factor):
+    """Mean of factor x factor blocks of a 2d array, padding the last
+    blocks with NaN so that no edge rows or columns are dropped."""
+    rows = -(-values.shape[0] // factor)
+    cols = -(-values.shape[1] // factor)
+    padded = np.full((rows * factor, cols * factor), np.nan)
+    padded[:values.shape[0], :values.shape[1]] = values
+    blocks = padded.reshape(rows, factor, cols, factor)
+    valid = np.isfinite(blocks)
+    with np.errstate(invalid='ignore'):
+        return (np.where(valid, blocks, 0).sum(axis=(1, 3))
+                / valid.sum(axis=(1, 3)))
+
+
+def plot_spatial_map(ds, cache_dir=None, max_size=1000):
     """
     This function is used to plot the map of the 100 m wind speed data.
 
     Inputs
     ----------
-    data   : The dataframe.
-    WSdata : either WS10m or WS100m data.
+    ds        : The spatial dataset.
+    cache_dir : Directory to store the time-mean fields (see time_mean).
+    max_size  : Maximum number of grid points plotted along each side.
 
     Returns
     -------
@@ -147,13 +249,84 @@ def plot_spatial_map(ds):
     os.chdir(current_dir)
     
     fig, axs = plt.subplots(1, 2, clear=True, figsize=(10, 6))
-    ds.WS10m.mean('time').plot(cmap='jet', ax=axs[0])
-    ds.WS100m.mean('time').plot(cmap='jet', ax=axs[1])
+    downsample(time_mean(ds, 'WS10m', cache_dir),
+               max_size).plot(cmap='jet', ax=axs[0])
+    downsample(time_mean(ds, 'WS100m', cache_dir),
+               max_size).plot(cmap='jet', ax=axs[1])
     fig.tight_layout()
     plt.show()
     fig.savefig('../docs/spatial_map.png', dpi=300)
 
 
+def render_map_tiles(ds, out_dir, variables=('WS10m', 'WS100m'),
+                     tile_size=256, cmap='jet', cache_dir=None):
+    """
+    This function writes the time-mean maps of the spatial data as a
+    pyramid of PNG tiles, so maps of large regions can be displayed without
+    loading the full resolution image. The last level is the ERA5 grid and
+    each level before it averages blocks of 2x2 points of the next one,
+    down to level 0 which fits in a single tile. The grid is padded, not
+    trimmed, so the last row and column of blocks may be partly empty.
+    The tiles are written to out_dir/<variable>/<level>/<row>_<col>.png,
+    together with an index.json describing the levels, their extent (centre
+    of the first and last pixels) and the color scale.
+
+    Inputs
+    ----------
+    ds (object)      : Spatial dataset.
+    out_dir (str)    : Directory where the tiles are written.
+    variables (list) : Variables to render.
+    tile_size (int)  : Number of pixels along each side of a tile.
+    cmap (str)       : Colormap of the tiles.
+    cache_dir (str)  : Directory to store the time-mean fields (see time_mean).
+
+    Returns
+    -------
+    Dictionary with the description of the tiles (also in index.json).
+    """
+    index = {}
+    for var in variables:
+        # north on top, west on the left
+        mean = time_mean(ds, var, cache_dir).sortby(
+            'latitude', ascending=False).sortby('longitude')
+        vmin, vmax = float(mean.min()), float(mean.max())
+        lat, lon = mean.latitude.values, mean.longitude.values
+        # grid spacing, assumed regular as in ERA5
+        dlat = (lat[-1] - lat[0]) / max(lat.size - 1, 1)
+        dlon = (lon[-1] - lon[0]) / max(lon.size - 1, 1)
+        size = max(lat.size, lon.size)
+        n_levels = max(int(np.ceil(np.log2(size / tile_size))), 0) + 1
+        levels = []
+        for level in range(n_levels):
+            factor = 2**(n_levels - 1 - level)
+            values = _block_mean(mean.values, factor)
+            rows = int(np.ceil(values.shape[0] / tile_size))
+            cols = int(np.ceil(values.shape[1] / tile_size))
+            level_dir = os.path.join(out_dir, var, str(level))
+            os.makedirs(level_dir, exist_ok=True)
+            for row in range(rows):
+                for col in range(cols):
+                    tile = values[row*tile_size:(row + 1)*tile_size,
+                                  col*tile_size:(col + 1)*tile_size]
+                    plt.imsave(os.path.join(level_dir, '{}_{}.png'.format(
+                        row, col)), tile, cmap=cmap, vmin=vmin, vmax=vmax)
+            # centres of the first and last blocks of the padded grid
+            first_lat = lat[0] + (factor - 1) / 2 * dlat
+            first_lon = lon[0] + (factor - 1) / 2 * dlon
+            levels.append({
+                'factor': factor, 'shape': list(values.shape),
+                'rows': rows, 'cols': cols,
+                'latitude': [float(first_lat), float(
+                    first_lat + (values.shape[0] - 1) * factor * dlat)],
+                'longitude': [float(first_lon), float(
+                    first_lon + (values.shape[1] - 1) * factor * dlon)]})
+        index[var] = {'levels': levels, 'tile_size': tile_size,
+                      'cmap': cmap, 'vmin': vmin, 'vmax': vmax}
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
 def plot_spatial_timeseries(ds, lat, lon):
     """
     This function is used to get the timeseries of a place (lat,lon) from the spatial data.
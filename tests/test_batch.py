@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import pytest
+
+from era5analysis import batch
+
+
+def write_jobs(tmp_path, jobs):
+    for folder in ['a', 'b']:
+        if not (tmp_path / folder).exists():
+            (tmp_path / folder).mkdir()
+            (tmp_path / folder / 't.wtg').write_text(folder)
+    jobfile = tmp_path / 'jobs.json'
+    jobfile.write_text(json.dumps({'jobs': jobs}))
+    return str(jobfile)
+
+
+def job(**kwargs):
+    settings = {'name': 'site', 'analysis': 'time_series', 'coords': [56, 8],
+                'period': ['2000-01-01', '2001-12-31'],
+                'turbines': ['a/t.wtg']}
+    settings.update(kwargs)
+    return settings
+
+
+@pytest.mark.parametrize('jobs', [
+    [job(), job()],  # same name
+    [job(turbines=['a/t.wtg', 'b/t.wtg'])],  # same turbine name
+    [job(frequency='monthly')],  # AEP from monthly data
+    [job(analysis='spatial', coords=[58, 2, 53, 9])],  # report without site
+])
+def test_load_jobs_rejects_invalid_jobs(tmp_path, jobs):
+    with pytest.raises(ValueError):
+        batch.load_jobs(write_jobs(tmp_path, jobs))
+
+
+def test_outputs_change_with_job_parameters(tmp_path):
+    def outputs(**kwargs):
+        jobs = batch.load_jobs(write_jobs(tmp_path, [job(**kwargs)]))['jobs']
+        tasks = batch.build_tasks(jobs, str(tmp_path / 'out'))
+        return {tid.split(':')[0]: task['output'] for tid, task in tasks.items()}
+
+    base = outputs()
+    assert set(base) == {'download', 'process', 'stats', 'aep', 'report'}
+    assert base == outputs()
+    # a new period invalidates the whole chain
+    new_period = outputs(period=['2000-01-01', '2002-12-31'])
+    assert all(new_period[kind] != base[kind] for kind in base)
+    # new AEP options or turbine only change the AEP
+    for changed in [outputs(aep={'horizon': 10}),
+                    outputs(turbines=['b/t.wtg'])]:
+        assert changed['aep'] != base['aep']
+        assert changed['stats'] == base['stats']
+
+
+def test_turbines_parsed_before_aep_tasks(tmp_path, monkeypatch):
+    parsed = []
+
+    class WindTurbines:
+        @staticmethod
+        def from_WAsP_wtg(wtg_file):
+            parsed.append(wtg_file)
+            return batch.get_AEP.TurbineTable([0, 30], [0, 0], [0, 0])
+
+    monkeypatch.setattr(batch.get_AEP, 'WindTurbines', WindTurbines)
+    jobs = batch.load_jobs(write_jobs(tmp_path, [
+        job(name='one'), job(name='two')]))['jobs']
+    tasks = batch.build_tasks(jobs, str(tmp_path / 'out'))
+    batch.prepare_turbines(tasks)
+    assert len(parsed) == 1
+    assert len(list((tmp_path / 'out' / 'cache' / 'turbines').iterdir())) == 1
+
+
+def test_missing_turbine_fails_only_its_task(tmp_path, capsys):
+    jobs = batch.load_jobs(write_jobs(tmp_path, [
+        job(name='one'), job(name='two', turbines=['c/t.wtg'])]))['jobs']
+    tasks = batch.build_tasks(jobs, str(tmp_path / 'out'))
+    assert 'aep:one:t' in tasks and 'aep:two:t' in tasks
+    batch.prepare_turbines({'aep:two:t': tasks['aep:two:t']})
+    assert 'WARNING aep:two:t' in capsys.readouterr().out
+
+
+def fake_run_task(kind, output, inputs, params):
+    '''Writes the output, except for statistics whose worker dies.'''
+    if kind == 'stats':
+        os._exit(1)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        f.write(kind)
+
+
+def test_run_tasks_survives_dead_worker(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, 'run_task', fake_run_task)
+    jobs = batch.load_jobs(write_jobs(tmp_path, [
+        job(name='one', turbines=[]), job(name='two', turbines=[])]))['jobs']
+    tasks = batch.build_tasks(jobs, str(tmp_path / 'out'))
+    done, failed, skipped = batch.run_tasks(tasks, workers=1)
+    # tasks queued on the dead worker fail with it, the batch goes on
+    assert {'stats:one', 'stats:two'} <= failed
+    assert {tid for tid in tasks if tid.startswith(('download', 'process'))} <= done
+    assert done | failed | skipped == set(tasks)
+
+
+def test_run_task_closes_figures(tmp_path, monkeypatch):
+    def get_stats(data, analysis):
+        batch.plt.figure()
+        return 'stats'
+
+    monkeypatch.setattr(batch.get_stats, 'get_stats', get_stats)
+    data = str(tmp_path / 'data.pkl')
+    batch._dump('data', data)
+    batch.run_task('stats', str(tmp_path / 'stats.pkl'), [data],
+                   {'analysis': 'time_series'})
+    assert batch.plt.get_fignums() == []
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from era5analysis import get_AEP
+
+
+def turbine():
+    '''Simple 2 MW turbine with cut-in at 3 m/s and cut-out at 25 m/s.'''
+    ws = np.array([0, 2.999, 3, 12, 25, 25.001, 40])
+    power = np.array([0, 0, 0, 2e6, 2e6, 0, 0])
+    ct = np.array([0, 0, 0.8, 0.8, 0.1, 0, 0])
+    return get_AEP.TurbineTable(ws, power, ct)
+
+
+def wind_data(years=10, seed=0):
+    time = pd.date_range(f'{2000}-01-01', f'{2000 + years - 1}-12-31 23:00',
+                         freq='h')
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'WS10m': 6 * rng.weibull(2, time.size),
+                         'WS100m': 8 * rng.weibull(2, time.size)}, index=time)
+
+
+def test_power_lookup_bin_centres():
+    power = get_AEP.power_lookup(turbine(), ws_step=0.5, ws_max=40)
+    assert power.size == 80
+    assert power[0] == 0  # 0.25 m/s
+    assert power[15] == pytest.approx(turbine().power(7.75))
+
+
+def test_block_codes():
+    time = pd.date_range('2000-01-01', '2001-12-31 23:00', freq='h')
+    starts, stops = get_AEP._block_codes(time, 'year')
+    np.testing.assert_array_equal(starts, [0, 366 * 24])
+    np.testing.assert_array_equal(stops, [366 * 24, 731 * 24])
+    starts, stops = get_AEP._block_codes(np.arange(10), 4)
+    np.testing.assert_array_equal(starts, [0, 4])
+    np.testing.assert_array_equal(stops, [4, 8])
+
+
+def test_block_codes_leave_out_incomplete_years(capsys):
+    time = pd.date_range('2000-12-31 22:00', '2002-01-01 01:00', freq='h')
+    starts, stops = get_AEP._block_codes(time, 'year')
+    np.testing.assert_array_equal(starts, [2])
+    np.testing.assert_array_equal(stops, [2 + 365 * 24])
+    assert '2 years' in capsys.readouterr().out
+
+
+def test_incomplete_year_does_not_change_aep():
+    data = wind_data()
+    extra = pd.concat([data, wind_data(years=11, seed=5).loc['2010-01']])
+    aep = get_AEP.AEP_bootstrap(data, 'time_series', turbine(), seed=1)
+    aep_extra = get_AEP.AEP_bootstrap(extra, 'time_series', turbine(), seed=1)
+    pd.testing.assert_frame_equal(aep, aep_extra)
+
+
+def test_p50_matches_direct_aep():
+    data = wind_data()
+    aep = get_AEP.AEP_bootstrap(data, 'time_series', turbine(), seed=1)
+    direct = 365 * 24 * turbine().power(data.WS100m.values).mean() / 1e6
+    assert aep.loc['P50', 'AEP100m'] == pytest.approx(direct, rel=0.01)
+
+
+def test_p90_below_p50_and_narrows_with_horizon():
+    data = wind_data()
+    one = get_AEP.AEP_bootstrap(data, 'time_series', turbine(), seed=1)
+    ten = get_AEP.AEP_bootstrap(data, 'time_series', turbine(), horizon=10,
+                                seed=1)
+    assert (one.loc['P90'] <= one.loc['P50']).all()
+    assert (ten.loc['P50'] - ten.loc['P90'] < one.loc['P50'] - one.loc['P90']).all()
+
+
+def test_workers_match_serial():
+    data = wind_data(years=3)
+    ds = xr.Dataset(
+        {var: (('time', 'latitude', 'longitude'),
+               np.stack([data[var].values * f for f in [0.8, 1, 1.2]], axis=1)
+               [:, :, None] * np.ones(2))
+         for var in ['WS10m', 'WS100m']},
+        coords={'time': data.index, 'latitude': [1, 2, 3],
+                'longitude': [1, 2]})
+    serial = get_AEP.AEP_bootstrap(ds, 'spatial', turbine(), seed=2)
+    chunked = get_AEP.AEP_bootstrap(ds, 'spatial', turbine(), seed=2,
+                                    chunk_bytes=1)
+    parallel = get_AEP.AEP_bootstrap(ds, 'spatial', turbine(), seed=2,
+                                     chunk_bytes=1, n_workers=2)
+    xr.testing.assert_allclose(serial, chunked)
+    xr.testing.assert_allclose(serial, parallel)
+    assert serial.AEP100m.dims == ('pvalue', 'latitude', 'longitude')
+
+
+def test_single_year_raises():
+    with pytest.raises(ValueError):
+        get_AEP.AEP_bootstrap(wind_data(years=1), 'time_series', turbine())
+
+
+def test_nan_wind_speeds_are_ignored():
+    data = wind_data()
+    missing = data.copy()
+    missing.iloc[np.random.default_rng(3).choice(len(data), 5000), :] = np.nan
+    aep = get_AEP.AEP_bootstrap(data, 'time_series', turbine(), seed=1)
+    aep_missing = get_AEP.AEP_bootstrap(missing, 'time_series', turbine(),
+                                        seed=1)
+    assert np.isfinite(aep_missing.values).all()
+    np.testing.assert_allclose(aep_missing, aep, rtol=0.005)
+
+
+class FakeWindTurbines:
+    '''Stands in for PyWake's WindTurbines, counting the parsed files.'''
+    parsed = []
+
+    def __init__(self, rated):
+        self.rated = rated
+
+    @classmethod
+    def from_WAsP_wtg(cls, wtg_file):
+        cls.parsed.append(wtg_file)
+        return cls(float(open(wtg_file).read()))
+
+    def power(self, ws):
+        ws = np.asarray(ws)
+        return np.where((ws >= 3) & (ws <= 25),
+                        self.rated * np.clip((ws - 3) / 9, 0, 1), 0)
+
+    def ct(self, ws):
+        return np.where((np.asarray(ws) >= 3) & (np.asarray(ws) <= 25), 0.8, 0)
+
+
+@pytest.fixture
+def wtg_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_AEP, 'WindTurbines', FakeWindTurbines)
+    FakeWindTurbines.parsed = []
+    files = []
+    for i, rated in enumerate([2e6, 3e6]):
+        files.append(str(tmp_path / f't{i}.wtg'))
+        with open(files[-1], 'w') as f:
+            f.write(str(rated))
+    return files
+
+
+def test_registry_cut_in_and_cut_out_are_exact(wtg_files):
+    table = get_AEP.TurbineRegistry().get(wtg_files[0])
+    np.testing.assert_allclose(table.power([2.999, 12, 24.999, 25.001]),
+                               [0, 2e6, 2e6, 0], atol=1)
+    np.testing.assert_allclose(table.ct([24.999, 25.001]), [0.8, 0], atol=1e-3)
+
+
+def test_registry_lru_eviction(wtg_files):
+    registry = get_AEP.TurbineRegistry(maxsize=1)
+    registry.get(wtg_files[0])
+    registry.get(wtg_files[0])
+    assert len(FakeWindTurbines.parsed) == 1
+    registry.get(wtg_files[1])
+    assert len(registry) == 1
+    registry.get(wtg_files[0])
+    assert len(FakeWindTurbines.parsed) == 3
+
+
+def test_registry_mtime_invalidation(wtg_files):
+    registry = get_AEP.TurbineRegistry()
+    assert registry.get(wtg_files[0]).power(20) == pytest.approx(2e6)
+    with open(wtg_files[0], 'w') as f:
+        f.write('4e6')
+    os.utime(wtg_files[0], (1, 1))
+    assert registry.get(wtg_files[0]).power(20) == pytest.approx(4e6)
+    assert len(FakeWindTurbines.parsed) == 2
+
+
+def test_registry_reloads_tables_from_disk(wtg_files, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    table = get_AEP.TurbineRegistry(cache_dir=cache_dir).get(wtg_files[0])
+    reloaded = get_AEP.TurbineRegistry(cache_dir=cache_dir).get(wtg_files[0])
+    assert len(FakeWindTurbines.parsed) == 1
+    assert len(os.listdir(cache_dir)) == 1
+    ws = np.linspace(0, 30, 301)
+    np.testing.assert_array_equal(reloaded.power(ws), table.power(ws))
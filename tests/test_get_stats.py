@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from era5analysis import get_stats
+
+
+def spatial_data(n_lat=6, n_lon=8, value=None, seed=0):
+    time = pd.date_range('2000-01-01', periods=10, freq='D')
+    lat = 80 - 0.25 * np.arange(n_lat)
+    lon = 0.25 * np.arange(n_lon)
+    rng = np.random.default_rng(seed)
+    shape = (time.size, n_lat, n_lon)
+    return xr.Dataset(
+        {var: (('time', 'latitude', 'longitude'),
+               rng.random(shape) if value is None else np.full(shape, value))
+         for var in ['WS10m', 'WS100m']},
+        coords={'time': time, 'latitude': lat, 'longitude': lon})
+
+
+@pytest.fixture(autouse=True)
+def clear_time_means():
+    get_stats._time_means.clear()
+
+
+def test_time_mean_depends_on_data(tmp_path):
+    ds, ds2 = spatial_data(), spatial_data(value=5)
+    for cache_dir in [None, str(tmp_path)]:
+        xr.testing.assert_allclose(get_stats.time_mean(ds, 'WS10m', cache_dir),
+                                   ds.WS10m.mean('time'))
+        assert (get_stats.time_mean(ds2, 'WS10m', cache_dir) == 5).all()
+
+
+def test_time_mean_sees_every_value():
+    ds = spatial_data(n_lat=64, n_lon=64)
+    ds2 = ds.copy(deep=True)
+    ds2.WS10m[:, 1, 1] += 10
+    get_stats.time_mean(ds, 'WS10m')
+    assert float(get_stats.time_mean(ds2, 'WS10m')[1, 1]) == pytest.approx(
+        float(ds.WS10m[:, 1, 1].mean()) + 10)
+
+
+def test_time_mean_keyed_on_source_file(tmp_path):
+    source = str(tmp_path / 'era5.nc')
+    spatial_data().to_netcdf(source)
+    with xr.open_dataset(source) as ds:
+        mean = get_stats.time_mean(ds, 'WS10m', str(tmp_path / 'cache'))
+    spatial_data(value=5).to_netcdf(source)
+    os.utime(source, (1, 1))
+    with xr.open_dataset(source) as ds:
+        assert ds.encoding['source'] == source
+        assert (get_stats.time_mean(ds, 'WS10m', str(tmp_path / 'cache'))
+                == 5).all()
+    assert (mean != 5).all()
+
+
+def test_time_mean_reloads_from_disk(tmp_path, monkeypatch):
+    ds = spatial_data()
+    mean = get_stats.time_mean(ds, 'WS10m', str(tmp_path))
+    get_stats._time_means.clear()
+    monkeypatch.setattr(xr.DataArray, 'mean', None)  # must not reduce again
+    xr.testing.assert_identical(get_stats.time_mean(ds, 'WS10m', str(tmp_path)),
+                                mean)
+
+
+def test_time_mean_memory_is_bounded():
+    for seed in range(get_stats._MAX_TIME_MEANS + 3):
+        get_stats.time_mean(spatial_data(seed=seed), 'WS10m')
+    assert len(get_stats._time_means) == get_stats._MAX_TIME_MEANS
+
+
+def test_render_map_tiles_pyramid(tmp_path):
+    ds = spatial_data(n_lat=640, n_lon=300)
+    index = get_stats.render_map_tiles(ds, str(tmp_path), variables=['WS10m'],
+                                       tile_size=256)
+    levels = index['WS10m']['levels']
+    assert [level['shape'] for level in levels] == [[160, 75], [320, 150],
+                                                    [640, 300]]
+    assert [level['factor'] for level in levels] == [4, 2, 1]
+    # the full resolution level covers the whole grid
+    assert levels[2]['latitude'] == [80, pytest.approx(80 - 0.25 * 639)]
+    assert levels[2]['longitude'] == [0, pytest.approx(0.25 * 299)]
+    assert levels[1]['latitude'] == [pytest.approx(80 - 0.125),
+                                     pytest.approx(80 - 0.125 - 0.5 * 319)]
+    assert sorted(os.listdir(tmp_path / 'WS10m' / '2')) == [
+        '0_0.png', '0_1.png', '1_0.png', '1_1.png', '2_0.png', '2_1.png']
+    with open(tmp_path / 'index.json') as f:
+        assert json.load(f) == index
+
+
+def test_block_mean_pads_edges():
+    values = np.arange(35.).reshape(5, 7)
+    blocks = get_stats._block_mean(values, 4)
+    assert blocks.shape == (2, 2)
+    assert blocks[0, 0] == values[:4, :4].mean()
+    assert blocks[1, 1] == values[4:, 4:].mean()